@@ -12,100 +12,365 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
+import hashlib
 import json
 import logging
 import os
+import random
 import re
+import signal
 import sys
 import time
 from collections import Counter
-from datetime import timedelta
-from threading import Timer
-from typing import List, Dict, Optional
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from threading import Event, Lock, Thread
+from typing import Callable, List, Dict, Optional, Tuple
 
-import humanize
-from github import Github
+import requests
 from pybuildkite.buildkite import Buildkite
+from pybuildkite.client import Client
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError
 from urllib3.util.retry import Retry
 
 from github_action import GithubAction, logger
 
 
-INITIAL_DELAY = 5  # action initially delays accessing GitHub API for this number of seconds
 WAIT_ON_GITHUB_CHECK = 300  # seconds the action waits for a Buildkite check to appear on the commit
 LOG_EVERY_SECONDS = 60*60   # some logging only occurs every X seconds
+MAX_POLL_INTERVAL = 300  # seconds the poll interval grows up to while the build does not change
 DEFAULT_GITHUB_BASE_URL = "https://api.github.com"
+GITHUB_TIMEOUT = 15  # seconds to wait for GitHub API to connect and to respond
+BUILDKITE_TIMEOUT = (10, 60)  # seconds to wait for Buildkite (and artifact storage) to connect and to send data
+DEFAULT_DOWNLOAD_CONCURRENCY = 8  # number of artifacts downloaded in parallel
+ARTIFACT_PAGES_CONCURRENCY = 4  # number of artifact list pages fetched in parallel
+BUILD_POLLERS_POOL_SIZE = 4  # connections kept for builds polled in background, next to downloads or page fetches
+DOWNLOAD_CHUNK_SIZE = 1 << 20  # bytes of an artifact held in memory while downloading
+DOWNLOAD_STATES = frozenset({'new', 'finished'})  # artifacts in these states get downloaded
+DOWNLOAD_RETRY_DELAYS = (5, 20, 80, 320)  # seconds between download attempts, one attempt more than delays
+
+BUILDKITE_URL_PREFIXES = ('https://buildkite.com/', 'http://buildkite.com/')
+# patterns are compiled once here, make_path_safe and parse_buildkite_url must not use inline patterns
+BUILDKITE_URL_RE = re.compile(r'^https?://buildkite\.com/([^/]+)/([^/]+)/builds/([0-9]+)')
+# \w matches exactly the characters where str.isalnum() is true, plus underscore
+UNSAFE_CHARACTERS_RE = re.compile(r'[^\w-]')
+DASHES_RE = re.compile(r'-+')
+LEADING_DASHES_RE = re.compile(r'^-+')
+TRAILING_DASHES_RE = re.compile(r'-+$')
+
+# set to interrupt any sleep and download, e.g. when the action gets cancelled
+stop_event = Event()
+
+
+# sends GET requests with the ETag of the last response of that url (except for streams),
+# so unchanged resources are answered with 304 Not Modified and the memorized response is returned
+class ConditionalSession(requests.Session):
+
+    def __init__(self):
+        super().__init__()
+        self._responses: Dict[str, Tuple[str, requests.Response]] = dict()
+        self._lock = Lock()
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        if request.method != 'GET' or kwargs.get('stream'):
+            return super().send(request, **kwargs)
+
+        with self._lock:
+            etag, cached = self._responses.get(request.url, (None, None))
+        if etag is not None:
+            request.headers['If-None-Match'] = etag
+
+        response = super().send(request, **kwargs)
+        if response.status_code == 304 and cached is not None:
+            logger.debug('Not modified: %s', request.url)
+            return cached
+        if response.status_code == 200 and 'ETag' in response.headers:
+            with self._lock:
+                self._responses[request.url] = (response.headers['ETag'], response)
+        return response
+
+
+# pybuildkite's Client with requests sent through a (pooled) session and streams read in DOWNLOAD_CHUNK_SIZE chunks,
+# pybuildkite reads streams with chunk_size=None, which reads the entire body at once
+class BuildkiteClient(Client):
+
+    def __init__(self, session: requests.Session):
+        super().__init__()
+        self._session = session
+
+    def request(self, method, url, query_params=None, body=None, headers={}, with_pagination=False, as_stream=False):
+        if headers is None:
+            raise ValueError("headers cannot be None")
+
+        headers = dict(headers)
+        if self.access_token:
+            headers["Authorization"] = "Bearer {}".format(self.access_token)
+
+        if body:
+            body = self._clean_query_params(body)
+
+        query_params = self._clean_query_params(query_params or {})
+        query_params["per_page"] = "100"
+
+        query_params = self._convert_query_params_to_string_for_bytes(query_params)
+        response = self._session.request(
+            method,
+            url,
+            headers=headers,
+            params=str.encode(query_params),
+            json=body,
+            stream=as_stream,
+            timeout=BUILDKITE_TIMEOUT,
+        )
+
+        response.raise_for_status()
+
+        if with_pagination:
+            return self._get_paginated_response(response)
+        if method == "DELETE" or response.status_code == 204 or response.headers.get("content-type") is None:
+            return response.ok
+        if headers.get("Accept") is None or headers.get("Accept") == "application/json":
+            return response.json()
+        elif as_stream:
+            return response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE, decode_unicode=False)
+        else:
+            return response.content
+
 
+def get_session(retry: Optional[Retry] = None, pool_size: int = DEFAULT_DOWNLOAD_CONCURRENCY) -> requests.Session:
+    session = ConditionalSession()
+    # the pool should hold a connection per concurrent download, otherwise connections get discarded
+    adapter = HTTPAdapter(pool_maxsize=pool_size, max_retries=retry if retry is not None else 0)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
-def get_buildkite_builds_from_github(api_url: str, token: str, repo: str, commit: str) -> List[str]:
-    retry = Retry(total=10, backoff_factor=1)
-    gh = Github(token, base_url=api_url, retry=retry)
-    commit = gh.get_repo(repo).get_commit(commit)
-    status = commit.get_combined_status()
-    logger.debug('Found {} status{}:'.format(status.total_count, '' if status.total_count == 1 else 'es'))
-    for s in status.statuses:
-        logger.debug('{} - {}'.format(s, s.target_url))
 
-    return list([status.target_url
-                 for status in status.statuses
-                 if status.context.startswith('buildkite/')])
+def get_github(token: str) -> requests.Session:
+    github = get_session(Retry(total=10, backoff_factor=1,
+                               status_forcelist=[429, 500, 502, 503, 504],
+                               respect_retry_after_header=True))
+    github.headers['Authorization'] = 'token {}'.format(token)
+    github.headers['Accept'] = 'application/vnd.github+json'
+    return github
+
+
+def get_buildkite(token: str, download_concurrency: int = DEFAULT_DOWNLOAD_CONCURRENCY) -> Buildkite:
+    buildkite = Buildkite()
+    pool_size = max(download_concurrency, ARTIFACT_PAGES_CONCURRENCY) + BUILD_POLLERS_POOL_SIZE
+    buildkite.client = BuildkiteClient(get_session(pool_size=pool_size))
+    buildkite.set_access_token(token)
+    return buildkite
+
+
+def get_buildkite_builds_from_github(github: requests.Session, api_url: str, repo: str, commit: str) -> List[str]:
+    # the combined status lists 30 contexts per page by default, 100 at most
+    response = github.get('{}/repos/{}/commits/{}/status'.format(api_url, repo, commit), params={'per_page': 100},
+                          timeout=GITHUB_TIMEOUT)
+    response.raise_for_status()
+    status = response.json()
+    total_count = status.get('total_count', 0)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Found %d status%s:', total_count, '' if total_count == 1 else 'es')
+        for s in status.get('statuses', []):
+            logger.debug('%s (%s) - %s', s.get('context'), s.get('state'), s.get('target_url'))
+
+    return list([status.get('target_url')
+                 for status in status.get('statuses', [])
+                 if status.get('context', '').startswith('buildkite/')])
 
 
 def parse_buildkite_url(url) -> (str, str, int):
-    m = re.match('^http[s]?://buildkite.com/([^/]+)/([^/]+)/builds/([0-9]+)', url)
+    # cheap prefix check avoids the regex for urls that do not point to Buildkite (or are missing)
+    if not url or not url.startswith(BUILDKITE_URL_PREFIXES):
+        return None
+
+    m = BUILDKITE_URL_RE.match(url)
     if m:
         return m.group(1), m.group(2), int(m.group(3))
 
     return None
 
 
-def get_build(buildkite: Buildkite, org: str, pipeline: str, build_number: int) -> Dict:
-    return buildkite.builds().get_build_by_number(org, pipeline, build_number, include_retried_jobs=True)
+def parse_buildkite_urls(urls: List[str]) -> List[Tuple[str, str, int]]:
+    builds = []
+    for url in urls:
+        build = parse_buildkite_url(url)
+        if build is None:
+            # a missing or unsupported url of one status must not prevent downloading the other builds
+            logger.debug('Skipping status with unsupported Buildkite url: %s', url)
+            continue
+        builds.append(build)
+    return builds
+
+
+def get_backoff(attempt: int, cap: float, base: float = 2) -> float:
+    # exponential backoff starting at base seconds up to cap, with jitter
+    return min(cap, base * 2 ** min(attempt, 16)) * random.uniform(0.5, 1)
+
 
+def get_poll_interval(poll_interval: int, unchanged_polls: int) -> int:
+    # double the poll interval with every poll that did not observe any change, up to MAX_POLL_INTERVAL
+    return max(poll_interval, min(poll_interval * 2 ** min(unchanged_polls, 16), MAX_POLL_INTERVAL))
 
-def get_build_artifacts(buildkite: Buildkite, org: str, pipeline: str, build_number: int) -> List[Dict]:
-    list = buildkite.artifacts().list_artifacts_for_build
 
-    page = 1
-    artifacts = []
-    while page:
-        response = list(org, pipeline, build_number, page=page, with_pagination=True)
-        for artifact in response.body:
-            artifacts.append(artifact)
+def get_build(buildkite: Buildkite, org: str, pipeline: str, build_number: int,
+              include_retried_jobs: bool = True) -> Dict:
+    return buildkite.builds().get_build_by_number(org, pipeline, build_number,
+                                                  include_retried_jobs=include_retried_jobs)
+
+
+def get_build_artifacts(buildkite: Buildkite, org: str, pipeline: str, build_number: int,
+                        concurrency: int = ARTIFACT_PAGES_CONCURRENCY) -> List[Dict]:
+    list_artifacts = buildkite.artifacts().list_artifacts_for_build
+
+    def get_page(page: int):
+        logger.debug('Fetching page %d of artifacts.', page)
+        return list_artifacts(org, pipeline, build_number, page=page, with_pagination=True)
+
+    response = list_artifacts(org, pipeline, build_number, page=1, with_pagination=True)
+    artifacts = [artifact for artifact in response.body]
+
+    # with the last page known, all remaining pages can be fetched concurrently
+    if response.next_page and response.last_page:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for response in executor.map(get_page, range(response.next_page, response.last_page + 1)):
+                artifacts.extend(response.body)
+    else:
         page = response.next_page
-        if page:
-            logger.debug('Fetching page {} of artifacts.'.format(page))
+        while page:
+            response = get_page(page)
+            artifacts.extend(response.body)
+            page = response.next_page
 
-    return artifacts
+    # pages shift when artifacts get uploaded while listing, so the same artifact can appear on two pages
+    return list({artifact['id']: artifact for artifact in artifacts}.values())
 
 
+@lru_cache(maxsize=1024)
 def make_path_safe(string: str) -> str:
-    safe_characters = "".join(c if c.isalnum() or c in ['-', '_'] else '-' for c in string).strip()
+    safe_characters = UNSAFE_CHARACTERS_RE.sub('-', string)
     reduced = safe_characters[:150]
-    for pattern, repl in [('-+', '-'), ('^-+', ''), ('-+$', '')]:
-        reduced = re.sub(pattern, repl, reduced)
+    reduced = DASHES_RE.sub('-', reduced)
+    reduced = LEADING_DASHES_RE.sub('', reduced)
+    reduced = TRAILING_DASHES_RE.sub('', reduced)
     return reduced
 
 
 def make_dict_path_safe(job_names: Dict[str, str], job_runs: Dict[str, int]) -> Dict[str, str]:
     counts = Counter()
+    used_names = set()
     safe_dict = dict()
     for id, name in job_names.items():
         if id in job_runs:
             name = f'{name} run {job_runs[id]}'
-        safe_name = make_path_safe(name)
-        counts[safe_name] += 1
-        count = counts[safe_name]
-        if count > 1:
-            safe_name = f'{safe_name}_{count}'
+        base_name = make_path_safe(name)
+        count = counts[base_name] + 1
+        safe_name = base_name if count == 1 else f'{base_name}_{count}'
+        # a disambiguated name like 'name_2' may collide with a job that is actually called 'name_2'
+        while safe_name in used_names:
+            count += 1
+            safe_name = f'{base_name}_{count}'
+        counts[base_name] = count
+        used_names.add(safe_name)
         safe_dict[id] = safe_name
     return safe_dict
 
 
+def format_size(size: int, binary: bool = False) -> str:
+    # same format as humanize.naturalsize
+    base = 1024 if binary else 1000
+    units = ['KiB', 'MiB', 'GiB', 'TiB', 'PiB'] if binary else ['kB', 'MB', 'GB', 'TB', 'PB']
+    if size == 1:
+        return '1 Byte'
+    if size < base:
+        return '{} Bytes'.format(size)
+    for unit in units:
+        size /= base
+        if size < base or unit == units[-1]:
+            return '{:.1f} {}'.format(size, unit)
+
+
+def format_duration(seconds: float) -> str:
+    # same format as humanize.naturaldelta, for durations up to days
+    seconds = int(seconds)
+    if seconds < 1:
+        return 'a moment'
+    if seconds == 1:
+        return 'a second'
+    if seconds < 60:
+        return '{} seconds'.format(seconds)
+    if seconds < 120:
+        return 'a minute'
+    if seconds < 3600:
+        return '{} minutes'.format(seconds // 60)
+    if seconds < 7200:
+        return 'an hour'
+    return '{} hours'.format(seconds // 3600)
+
+
+def sleep(seconds: float) -> bool:
+    # returns True when the sleep got interrupted by stop_event
+    return stop_event.wait(seconds)
+
+
+def stop(signum: int, frame) -> None:
+    # interrupts sleeps and downloads, a second signal terminates the process as usual
+    stop_event.set()
+    signal.signal(signum, signal.SIG_DFL)
+
+
+def is_retriable(e: Exception) -> bool:
+    # errors other than HTTP errors (e.g. connection errors), rate limiting and server errors are retriable
+    return not isinstance(e, HTTPError) or e.response.status_code == 429 or 500 <= e.response.status_code < 600
+
+
+def get_retry_after(e: Exception) -> int:
+    # Retry-After header in seconds, the HTTP-date form is not supported
+    if not isinstance(e, HTTPError) or e.response is None:
+        return 0
+    retry_after = e.response.headers.get('Retry-After', '')
+    return int(retry_after) if retry_after.isdigit() else 0
+
+
+def is_downloaded(artifact: Dict, local_path: str) -> bool:
+    # an artifact is downloaded when a file with its size and sha1 checksum exists
+    try:
+        if os.stat(local_path).st_size != artifact.get('file_size'):
+            return False
+    except FileNotFoundError:
+        return False
+
+    if artifact.get('sha1sum'):
+        sha1 = hashlib.sha1()
+        with open(local_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+        return sha1.hexdigest() == artifact.get('sha1sum')
+
+    return True
+
+
+def preallocate(f, size: Optional[int]) -> bool:
+    # reserving the expected size upfront lets the file system allocate the file in few extents
+    if not size or not hasattr(os, 'posix_fallocate'):
+        return False
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+        return True
+    except OSError:
+        # not all file systems support preallocation
+        return False
+
+
 class Downloader:
 
-    _timer: Optional[Timer] = None
+    _progress: Optional[Thread] = None
+
+    def __init__(self, concurrency: int = DEFAULT_DOWNLOAD_CONCURRENCY, sleep: Callable[[float], bool] = sleep):
+        self._concurrency = concurrency
+        self._sleep = sleep
 
     def download_artifacts(self, buildkite: Buildkite,
                            org: str, pipeline: str, build_number: int, artifacts: List[Dict],
@@ -116,7 +381,17 @@ class Downloader:
         # sometimes artifacts are stuck in new state but can be downloaded just fine
         artifacts = [artifact
                      for artifact in artifacts
-                     if artifact['state'] in ['new', 'finished']]
+                     if artifact['state'] in DOWNLOAD_STATES]
+
+        # artifacts of the same job and path would overwrite each other, download only the last one
+        unique_artifacts = list({(artifact['job_id'], artifact['path']): artifact for artifact in artifacts}.values())
+        if len(unique_artifacts) < len(artifacts):
+            duplicates = len(artifacts) - len(unique_artifacts)
+            logger.warning('Skipping {} artifact{} with the same job and path as other artifacts.'.format(
+                duplicates,
+                '' if duplicates == 1 else 's'
+            ))
+            artifacts = unique_artifacts
 
         logger.info('Downloading {} artifact{} from build {}.'.format(
             len(artifacts),
@@ -125,73 +400,137 @@ class Downloader:
         ))
 
         attempt = 1
-        max_attempts = 5
+        max_attempts = len(DOWNLOAD_RETRY_DELAYS) + 1
         progress_interval = 20
         retry_artifact_ids = set()
         failed_artifact_ids = set()
+        not_found_artifact_ids = set()
+        cancelled_artifact_ids = set()
+        state_by_id = {artifact['id']: artifact['state'] for artifact in artifacts}
+        retry_after = 0
         root_path = os.path.abspath(path)
-        downloded_bytes = []
-
-        def download_artifact(artifact_id: str, job_id: str, file_path: str):
-            path_safe_job_name = path_safe_job_names.get(job_id, job_id)
-            local_path = os.path.abspath(os.path.join(path, path_safe_job_name, file_path))
+        job_paths = {job_id: os.path.join(root_path, name) for job_id, name in path_safe_job_names.items()}
+        total_artifacts = len(artifacts)
+        downloaded_artifacts = 0
+        downloaded_bytes = 0
+        created_dirs = set()
+        lock = Lock()
+        artifacts_api = buildkite.artifacts()
+
+        def download_artifact(artifact: Dict):
+            nonlocal downloaded_artifacts, downloaded_bytes, retry_after
+            artifact_id, job_id, file_path = artifact['id'], artifact['job_id'], artifact['path']
+            if stop_event.is_set():
+                # the action got cancelled, do not start any further download
+                with lock:
+                    cancelled_artifact_ids.add(artifact_id)
+                return None
+
+            job_path = job_paths.get(job_id) or os.path.join(root_path, job_id)
+            # job_path is absolute already, so normpath is equivalent to abspath, without calling os.getcwd
+            local_path = os.path.normpath(os.path.join(job_path, file_path))
             if not local_path.startswith(root_path):
                 raise RuntimeError("Cannot write artifact to '{}' as output path is '{}'".format(local_path, root_path))
-            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            # many artifacts share the same directory, create each only once
+            local_dir = os.path.dirname(local_path)
+            if local_dir not in created_dirs:
+                os.makedirs(local_dir, exist_ok=True)
+                with lock:
+                    created_dirs.add(local_dir)
+
+            if is_downloaded(artifact, local_path):
+                logger.debug('Skipping artifact %s as %s exists already.', artifact_id, local_path)
+                with lock:
+                    downloaded_artifacts += 1
+                return local_path
 
             try:
-                artifact = buildkite.artifacts().download_artifact(org, pipeline, build_number, job_id, artifact_id)
+                # stream the artifact to disk chunk by chunk rather than holding it in memory
+                chunks = artifacts_api.download_artifact(org, pipeline, build_number, job_id, artifact_id,
+                                                         as_stream=True)
 
-                logger.debug('Writing {} bytes to {}.'.format(len(artifact), local_path))
+                size = 0
                 with open(local_path, 'bw') as f:
-                    f.write(artifact)
-                downloded_bytes.append(len(artifact))
+                    preallocated = preallocate(f, artifact.get('file_size'))
+                    try:
+                        for chunk in chunks:
+                            if stop_event.is_set():
+                                raise RuntimeError('Download of artifact {} cancelled'.format(artifact_id))
+                            f.write(chunk)
+                            size += len(chunk)
+                    finally:
+                        if preallocated:
+                            # drop unwritten preallocated bytes, otherwise a broken stream leaves a file
+                            # of the listed size that looks downloaded on the next attempt
+                            f.truncate(size)
+                logger.debug('Wrote %d bytes to %s.', size, local_path)
+                with lock:
+                    downloaded_artifacts += 1
+                    downloaded_bytes += size
 
                 return local_path
             except Exception as e:
-                logger.debug(f'Downloading artifact {artifact_id} to {local_path} failed.', exc_info=e)
-                if not isinstance(e, HTTPError) or 500 <= e.response.status_code < 600:
-                    retry_artifact_ids.add(artifact_id)
-                else:
-                    failed_artifact_ids.add(artifact_id)
-
-        def get_progress_timer():
-            timer = Timer(progress_interval, log_progress)
-            timer.daemon = True
-            timer.start()
-            return timer
-
-        def log_progress():
-            logger.info('Downloaded {} artifact{} and {} so far ({:.1f}%).'.format(
-                len(downloaded_files),
-                '' if len(downloaded_files) == 1 else 's',
-                humanize.naturalsize(sum(downloded_bytes), binary=True),
-                len(downloaded_files) / max(len(artifacts), 1) * 100
-            ))
-            self._timer = get_progress_timer()
+                logger.debug('Downloading artifact %s to %s failed.', artifact_id, local_path, exc_info=e)
+                with lock:
+                    if stop_event.is_set():
+                        cancelled_artifact_ids.add(artifact_id)
+                    elif is_retriable(e):
+                        retry_artifact_ids.add(artifact_id)
+                        retry_after = max(retry_after, get_retry_after(e))
+                    else:
+                        failed_artifact_ids.add(artifact_id)
+                        if e.response.status_code == 404:
+                            not_found_artifact_ids.add(artifact_id)
+
+        def log_progress(stop: Event):
+            while not stop.wait(progress_interval):
+                with lock:
+                    downloaded, size = downloaded_artifacts, downloaded_bytes
+                logger.info('Downloaded {} artifact{} and {} so far ({:.1f}%).'.format(
+                    downloaded,
+                    '' if downloaded == 1 else 's',
+                    format_size(size, binary=True),
+                    downloaded / max(total_artifacts, 1) * 100
+                ))
 
         downloaded_files = []
         while artifacts and attempt <= max_attempts:
             # start to log progress
-            self._timer = get_progress_timer()
+            stop_progress = Event()
+            self._progress = Thread(target=log_progress, args=(stop_progress,), daemon=True)
+            self._progress.start()
 
-            for artifact in artifacts:
-                file = download_artifact(artifact['id'], artifact['job_id'], artifact['path'])
-
-                # memorize all successful download files
-                if file is not None:
-                    downloaded_files.append(file)
-
-            # stop progress logging
-            self._timer.cancel()
-
-            # move failed artifacts that are in new state into retry
-            failed_new_state_artifacts_ids = [artifact['id']
-                                              for artifact in artifacts
-                                              if artifact['id'] in failed_artifact_ids
-                                              and artifact['state'] == 'new']
-            retry_artifact_ids.update(failed_new_state_artifacts_ids)
-            failed_artifact_ids.difference_update(failed_new_state_artifacts_ids)
+            try:
+                # download artifacts concurrently, map returns files in the order of artifacts
+                with ThreadPoolExecutor(max_workers=self._concurrency) as executor:
+                    files = executor.map(download_artifact, artifacts)
+
+                    # memorize all successful download files
+                    downloaded_files.extend([file for file in files if file is not None])
+            finally:
+                # stop progress logging, also when a download raised
+                stop_progress.set()
+                self._progress.join()
+
+            # move artifacts that are in new state and were not found into retry, they might not be uploaded yet,
+            # all other failures are permanent and do not delay the download by retrying
+            failed_new_state_artifacts_ids = {artifact_id
+                                              for artifact_id in not_found_artifact_ids
+                                              if state_by_id[artifact_id] == 'new'}
+            retry_artifact_ids |= failed_new_state_artifacts_ids
+            failed_artifact_ids -= failed_new_state_artifacts_ids
+            not_found_artifact_ids.clear()
+
+            # do not retry anything once the action got cancelled
+            if stop_event.is_set():
+                cancelled_artifact_ids |= retry_artifact_ids
+                if cancelled_artifact_ids:
+                    ga.warning('Download of {} artifact{} cancelled.'.format(
+                        len(cancelled_artifact_ids),
+                        '' if len(cancelled_artifact_ids) == 1 else 's'
+                    ))
+                    failed_artifact_ids |= cancelled_artifact_ids
+                break
 
             # prepare next attempt
             artifacts = [artifact
@@ -199,33 +538,43 @@ class Downloader:
                          if artifact['id'] in retry_artifact_ids]
             retry_artifact_ids.clear()
 
-            # compute delay to next attempt
-            retry = attempt - 1
-            wait = timedelta(seconds=5 * 4 ** retry)
-
             # log next attempt
+            retry = attempt - 1
             attempt += 1
             if artifacts and attempt <= max_attempts:
+                # compute delay to next attempt, honor Retry-After and add jitter so that
+                # concurrent actions that hit the same rate limit do not retry at the same time
+                delay = max(DOWNLOAD_RETRY_DELAYS[retry], retry_after)
+                wait = delay + random.uniform(0, delay * 0.2)
+                retry_after = 0
+
                 logger.info('Download of {} artifact{} failed, retrying in {}.'.format(
                     len(artifacts),
                     '' if len(artifacts) == 1 else 's',
-                    humanize.naturaldelta(wait)
+                    format_duration(wait)
                 ))
-                time.sleep(wait.seconds)
+                if self._sleep(wait):
+                    ga.warning('Download of {} artifact{} cancelled.'.format(
+                        len(artifacts),
+                        '' if len(artifacts) == 1 else 's'
+                    ))
+                    failed_artifact_ids.update(artifact['id'] for artifact in artifacts)
+                    break
             elif artifacts:
                 ga.warning('Download of {} artifact{} failed, giving up.'.format(
                     len(artifacts),
                     '' if len(artifacts) == 1 else 's'
                 ))
-                logger.debug('Failed artifacts:')
-                for artifact in artifacts:
-                    logger.debug(artifact)
-                failed_artifact_ids.update([artifact['id'] for artifact in artifacts])
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug('Failed artifacts:')
+                    for artifact in artifacts:
+                        logger.debug(artifact)
+                failed_artifact_ids.update(artifact['id'] for artifact in artifacts)
 
         logger.info('Downloaded {} artifact{} and {}{}.'.format(
             len(downloaded_files),
             '' if len(downloaded_files) == 1 else 's',
-            humanize.naturalsize(sum(downloded_bytes)),
+            format_size(downloaded_bytes),
             ', {} artifact{} failed'.format(
                 len(failed_artifact_ids),
                 '' if len(failed_artifact_ids) == 1 else 's'
@@ -235,70 +584,125 @@ class Downloader:
         return downloaded_files, failed_artifact_ids
 
 
+def wait_for_build(buildkite: Buildkite, org: str, pipeline: str, build_number: int,
+                   poll_interval: int, cancel: Optional[Event] = None) -> Optional[Dict]:
+    # polls the build until it terminates, returns None when cancelled via stop_event or cancel
+    logger.info('Waiting for build {} to finish.'.format(build_number))
+
+    def get(include_retried_jobs: bool) -> Optional[Dict]:
+        # retries transient errors, returns None when cancelled
+        while True:
+            # checked before every request, so each sleep is followed by a check
+            if cancel is not None and cancel.is_set():
+                return None
+            try:
+                return get_build(buildkite, org, pipeline, build_number, include_retried_jobs=include_retried_jobs)
+            except Exception as e:
+                if not is_retriable(e):
+                    raise
+                wait = max(poll_interval, get_retry_after(e))
+                logger.info(f'Getting build {build_number} failed, retrying in {wait}s.', exc_info=e)
+                if sleep(wait):
+                    return None
+
+    last_build = None
+    unchanged_polls = 0
+    last_log = 0
+    last_state = None
+    while True:
+        # polling only needs the build state, retried jobs are fetched once the build terminates
+        build = get(include_retried_jobs=False)
+        if build is None:
+            return None
+
+        # poll less often while nothing changes, e.g. while waiting for long-running jobs
+        unchanged_polls = unchanged_polls + 1 if build == last_build else 0
+        last_build = build
+
+        state = build['state']
+        if state != last_state:
+            logger.info('Build {} is in ''{}'' state.'.format(build_number, state))
+            last_state = state
+        if state not in ['scheduled', 'running', 'canceling', 'failing']:
+            break
+        if time.time() - last_log >= LOG_EVERY_SECONDS:
+            logger.debug('%s for build %s to finish.',
+                         'Still waiting' if last_log > 0 else 'Waiting',
+                         build_number)
+            last_log = time.time()
+        if sleep(get_poll_interval(poll_interval, unchanged_polls)):
+            return None
+
+    return get(include_retried_jobs=True)
+
+
+def wait_for_build_in_background(buildkite: Buildkite, org: str, pipeline: str, build_number: int,
+                                 poll_interval: int, cancel: Optional[Event] = None) -> Future:
+    future = Future()
+
+    def wait():
+        future.set_running_or_notify_cancel()
+        try:
+            future.set_result(wait_for_build(buildkite, org, pipeline, build_number, poll_interval, cancel))
+        except BaseException as e:
+            future.set_exception(e)
+
+    # daemon threads do not hold up exiting once the first non-skipped build has been downloaded
+    Thread(target=wait, daemon=True).start()
+    return future
+
+
 def main(github_api_url: str, github_token: str, repo: str,
          buildkite: Buildkite, buildkite_url: str,
          ignore_build_states: List[str], ignore_job_states: List[str],
-         commit: str, output_path: str, poll_interval: int,
+         commit: str, output_path: str, poll_interval: int, download_concurrency: int,
          ga: GithubAction) -> bool:
 
     if buildkite_url is None:
         # get the Buildkite url from github
-        logger.debug('Waiting {}s before contacting GitHub API the first time.'.format(INITIAL_DELAY))
-
+        # reusing the session allows GitHub to respond with 304 Not Modified while the status does not change
+        github = get_github(github_token)
         start = time.time()
-        time.sleep(INITIAL_DELAY)
+        attempt = 0
         while True:
-            buildkite_builds = get_buildkite_builds_from_github(github_api_url, github_token, repo, commit)
+            buildkite_builds = get_buildkite_builds_from_github(github, github_api_url, repo, commit)
             if len(buildkite_builds) > 0:
                 break
 
             if time.time() - start >= WAIT_ON_GITHUB_CHECK:
                 ga.warning('Waited {} for a BuildKite check to appear on commit {}, giving up.'.format(
-                    humanize.naturaldelta(timedelta(seconds=WAIT_ON_GITHUB_CHECK)), commit
+                    format_duration(WAIT_ON_GITHUB_CHECK), commit
                 ))
                 return False
 
-            logger.debug('Waiting {}s before contacting GitHub API again'.format(poll_interval))
-            time.sleep(poll_interval)
+            # poll often at first to pick up the check quickly, then back off to poll_interval
+            wait = get_backoff(attempt, poll_interval)
+            attempt += 1
+            logger.debug('Waiting %.0fs before contacting GitHub API again', wait)
+            if sleep(wait):
+                return False
 
         if not logger.isEnabledFor(logging.DEBUG):
             logger.info('Found {} status{}.'.format(len(buildkite_builds), '' if len(buildkite_builds) == 1 else 'es'))
     else:
         buildkite_builds = [buildkite_url]
 
-    # downloads only the first non-skipped build
-    for url in buildkite_builds:
-        org, pipeline, build_number = parse_buildkite_url(url)
+    # wait for all builds concurrently, but download only the first non-skipped build
+    builds = parse_buildkite_urls(buildkite_builds)
+    if not builds:
+        ga.warning('None of the Buildkite urls is supported: {}'.format(', '.join(map(str, buildkite_builds))))
+        return False
+    # set once a build is chosen, so the other builds stop being polled
+    cancel_waits = Event()
+    futures = [wait_for_build_in_background(buildkite, org, pipeline, build_number, poll_interval, cancel_waits)
+               for org, pipeline, build_number in builds]
+    for (org, pipeline, build_number), future in zip(builds, futures):
         ga.add_to_output('build-number', str(build_number))
-        logger.info('Waiting for build {} to finish.'.format(build_number))
 
         # wait until the Buildkite build terminates
-        build = None
-        last_log = 0
-        last_state = None
-        while True:
-            try:
-                build = get_build(buildkite, org, pipeline, build_number)
-            except Exception as e:
-                if not isinstance(e, HTTPError) or 500 <= e.response.status_code < 600:
-                    logger.info(f'Getting build {build_number} failed, retrying in {poll_interval}s.', exc_info=e)
-                    time.sleep(poll_interval)
-                    continue
-                raise
-
-            state = build['state']
-            if state != last_state:
-                logger.info('Build is in ''{}'' state.'.format(state))
-                last_state = state
-            if state not in ['scheduled', 'running', 'canceling', 'failing']:
-                break
-            if time.time() - last_log >= LOG_EVERY_SECONDS:
-                logger.debug('{} for build {} to finish.'.format(
-                    'Still waiting' if last_log > 0 else 'Waiting',
-                    build_number
-                ))
-                last_log = time.time()
-            time.sleep(poll_interval)
+        build = future.result()
+        if build is None:
+            return False
 
         # set build state output
         state = build['state']
@@ -309,6 +713,7 @@ def main(github_api_url: str, github_token: str, repo: str,
             ga.add_to_output('download-paths', '[]')
             ga.add_to_output('download-files', '0')
             continue
+        cancel_waits.set()
 
         # get a job-id -> name mapping from build
         job_names = dict([(job.get('id'), job.get('name'))
@@ -331,29 +736,32 @@ def main(github_api_url: str, github_token: str, repo: str,
         artifacts = get_build_artifacts(buildkite, org, pipeline, build_number)
         logger.info('Found {} artifact{}.'.format(len(artifacts), '' if len(artifacts) == 1 else 's'))
 
-        new_artifacts = [artifact for artifact in artifacts if artifact['state'] == 'new']
-        if any(new_artifacts):
-            logger.debug('{} artifacts still in new state.'.format(len(new_artifacts)))
-            for artifact in new_artifacts:
-                logger.debug('New artifact: {}.'.format(artifact))
+        if logger.isEnabledFor(logging.DEBUG):
+            new_artifacts = [artifact for artifact in artifacts if artifact['state'] == 'new']
+            if new_artifacts:
+                logger.debug('%d artifacts still in new state.', len(new_artifacts))
+                for artifact in new_artifacts:
+                    logger.debug('New artifact: %s.', artifact)
 
         for ignore_job_state in ignore_job_states:
             ignore_artifacts = [artifact
                                 for artifact in artifacts
                                 if job_states.get(artifact['job_id']) == ignore_job_state]
 
-            if any(ignore_artifacts):
-                artifacts = [artifact for artifact in artifacts if artifact not in ignore_artifacts]
+            if ignore_artifacts:
+                ignore_artifact_ids = {artifact['id'] for artifact in ignore_artifacts}
+                artifacts = [artifact for artifact in artifacts if artifact['id'] not in ignore_artifact_ids]
                 logger.info('Ignoring {} artifact{} of {} jobs.'.format(
                     len(ignore_artifacts),
                     '' if len(ignore_artifacts) == 1 else 's',
                     ignore_job_state
                 ))
-                for artifact in ignore_artifacts:
-                    logger.debug('Ignored artifact: {}'.format(artifact))
+                if logger.isEnabledFor(logging.DEBUG):
+                    for artifact in ignore_artifacts:
+                        logger.debug('Ignored artifact: %s', artifact)
 
         # download the Buildkite artifacts
-        downloaded_paths, failed_ids = Downloader().download_artifacts(
+        downloaded_paths, failed_ids = Downloader(download_concurrency).download_artifacts(
             buildkite, org, pipeline, build_number, artifacts, path_safe_job_names, output_path, ga
         )
 
@@ -370,7 +778,7 @@ def main(github_api_url: str, github_token: str, repo: str,
 
 
 def get_commit_sha(event: dict, event_name: str):
-    logger.debug("Action triggered by '{}' event.".format(event_name))
+    logger.debug("Action triggered by '%s' event.", event_name)
 
     # https://developer.github.com/webhooks/event-payloads/
     if event_name.startswith('pull_request'):
@@ -389,6 +797,9 @@ if __name__ == "__main__":
     log_level = get_var('LOG_LEVEL') or 'INFO'
     logger.level = logging.getLevelName(log_level)
 
+    # stop waiting when the action gets cancelled
+    signal.signal(signal.SIGTERM, stop)
+
     github_api_url = os.environ.get('GITHUB_API_URL') or DEFAULT_GITHUB_BASE_URL
     github_token = get_var('GITHUB_TOKEN')
     github_repo = get_var('GITHUB_REPOSITORY')
@@ -418,19 +829,22 @@ if __name__ == "__main__":
     check_var(buildkite_token, 'BUILDKITE_TOKEN', 'BuildKite token')
     check_var(commit, 'COMMIT', 'Commit')
 
-    buildkite = Buildkite()
-    buildkite.set_access_token(buildkite_token)
-
     poll_interval_str = get_var('POLL_INTERVAL')
     check_var(poll_interval_str, 'POLL_INTERVAL', 'Seconds between API polls')
     if not poll_interval_str.isdigit() or int(poll_interval_str) <= 0:
         raise RuntimeError('POLL_INTERVAL must be a positive integer: {}'.format(poll_interval_str))
     poll_interval = int(poll_interval_str)
 
+    download_concurrency_str = get_var('DOWNLOAD_CONCURRENCY') or str(DEFAULT_DOWNLOAD_CONCURRENCY)
+    if not download_concurrency_str.isdigit() or int(download_concurrency_str) <= 0:
+        raise RuntimeError('DOWNLOAD_CONCURRENCY must be a positive integer: {}'.format(download_concurrency_str))
+    download_concurrency = int(download_concurrency_str)
+
+    buildkite = get_buildkite(buildkite_token, download_concurrency)
     ga = GithubAction()
 
     if not main(github_api_url, github_token, github_repo,
                 buildkite, buildkite_url,
                 ignore_build_states, ignore_job_states,
-                commit, output_path, poll_interval, ga):
+                commit, output_path, poll_interval, download_concurrency, ga):
         sys.exit(1)
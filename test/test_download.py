@@ -1,6 +1,8 @@
-from glob import glob
+import contextlib
+import hashlib
+import io
 import tempfile
-from typing import Set, Mapping
+from typing import Iterator, Set, Mapping
 import requests
 import unittest
 
@@ -18,9 +20,137 @@ class DownloadTest(unittest.TestCase):
         self.assertEqual('abc-123-DEF', make_path_safe('abc 123  DEF'))
         self.assertEqual('some-paths', make_path_safe('some/paths/..'))
         self.assertEqual('some-characters', make_path_safe('some ⚡⚠✔✗ characters'))
+        self.assertEqual('unicode_äöü-ß-名前-٣', make_path_safe('unicode_äöü ß\t名前 ٣'))
         self.assertEqual('this-is-a-very-very-very-very-very-very-very-very-very-very-very-very-very-very-very-very-very-very-very-very-very-very-very-very-very-very-very-long',
                          make_path_safe('this is a very very very very very very very very very very very very very very very very very very very very very very very very very very very long path'))
 
+    def test_parse_buildkite_url(self):
+        self.assertEqual(('org', 'pipeline', 123), parse_buildkite_url('https://buildkite.com/org/pipeline/builds/123'))
+        self.assertEqual(('org', 'pipeline', 123), parse_buildkite_url('http://buildkite.com/org/pipeline/builds/123'))
+        self.assertEqual(('org', 'pipeline', 123), parse_buildkite_url('https://buildkite.com/org/pipeline/builds/123#job-id'))
+        self.assertIsNone(parse_buildkite_url('https://buildkite.com/org/pipeline'))
+        self.assertIsNone(parse_buildkite_url('https://buildkiteXcom/org/pipeline/builds/123'))
+        self.assertIsNone(parse_buildkite_url('https://ci.example.com/org/pipeline/builds/123'))
+        self.assertIsNone(parse_buildkite_url(''))
+        self.assertIsNone(parse_buildkite_url(None))
+
+    def test_parse_buildkite_urls(self):
+        self.assertEqual([], parse_buildkite_urls([]))
+        self.assertEqual([('org', 'pipeline', 1), ('org', 'pipeline', 2)],
+                         parse_buildkite_urls(['https://buildkite.com/org/pipeline/builds/1',
+                                               None,
+                                               'https://ci.example.com/org/pipeline/builds/3',
+                                               'https://buildkite.com/org/pipeline/builds/2']))
+
+    @staticmethod
+    def create_artifacts_pages_mock(pages: int, with_last_page: bool):
+        def list_artifacts(org, pipeline, build_number, page, with_pagination):
+            return mock.Mock(body=[{'id': f'id{page}-{i}'} for i in range(2)],
+                             next_page=page + 1 if page < pages else None,
+                             last_page=pages if with_last_page and page < pages else None)
+
+        list_artifacts_for_build = mock.Mock(side_effect=list_artifacts)
+        return mock.Mock(artifacts=mock.Mock(return_value=mock.Mock(list_artifacts_for_build=list_artifacts_for_build)))
+
+    def test_get_build_artifacts(self):
+        for with_last_page in [True, False]:
+            for pages in [1, 2, 5]:
+                with self.subTest(pages=pages, with_last_page=with_last_page):
+                    buildkite = self.create_artifacts_pages_mock(pages, with_last_page)
+                    artifacts = get_build_artifacts(buildkite, 'org', 'pipeline', 1)
+                    self.assertEqual([{'id': f'id{page}-{i}'} for page in range(1, pages + 1) for i in range(2)], artifacts)
+                    self.assertCountEqual(
+                        [mock.call('org', 'pipeline', 1, page=page, with_pagination=True) for page in range(1, pages + 1)],
+                        buildkite.artifacts.return_value.list_artifacts_for_build.mock_calls
+                    )
+
+    def test_get_build_artifacts_overlapping_pages(self):
+        pages = {1: mock.Mock(body=[{'id': 'id1'}, {'id': 'id2'}], next_page=2, last_page=None),
+                 2: mock.Mock(body=[{'id': 'id2'}, {'id': 'id3'}], next_page=None, last_page=None)}
+        buildkite = mock.Mock()
+        buildkite.artifacts.return_value.list_artifacts_for_build.side_effect = \
+            lambda org, pipeline, build_number, page, with_pagination: pages[page]
+        self.assertEqual([{'id': 'id1'}, {'id': 'id2'}, {'id': 'id3'}],
+                         get_build_artifacts(buildkite, 'org', 'pipeline', 1))
+
+    def test_get_backoff(self):
+        with mock.patch('download_artifacts.random.uniform', return_value=1) as uniform:
+            self.assertEqual([2, 4, 8, 16, 30, 30], [get_backoff(attempt, 30) for attempt in range(6)])
+            self.assertEqual(30, get_backoff(1000, 30))
+            self.assertEqual(1, get_backoff(0, 30, base=1))
+            uniform.assert_called_with(0.5, 1)
+        with mock.patch('download_artifacts.random.uniform', return_value=0.5):
+            self.assertEqual([1, 2, 4, 8, 15, 15], [get_backoff(attempt, 30) for attempt in range(6)])
+
+    def test_get_poll_interval(self):
+        self.assertEqual([30, 60, 120, 240, 300, 300], [get_poll_interval(30, polls) for polls in range(6)])
+        self.assertEqual(300, get_poll_interval(30, 1000))
+        self.assertEqual(600, get_poll_interval(600, 0))
+        self.assertEqual(600, get_poll_interval(600, 3))
+
+    def test_stop(self):
+        stop_event = Event()
+        with mock.patch('download_artifacts.stop_event', stop_event), \
+                mock.patch('download_artifacts.signal.signal') as set_signal:
+            stop(signal.SIGTERM, None)
+            self.assertTrue(stop_event.is_set())
+            set_signal.assert_called_once_with(signal.SIGTERM, signal.SIG_DFL)
+
+    def test_wait_for_build(self):
+        running = {'state': 'running'}
+        passed = {'state': 'passed'}
+        passed_with_retries = {'state': 'passed', 'jobs': [{'id': 'jid1', 'retried': True}, {'id': 'jid2'}]}
+        buildkite = mock.MagicMock()
+        with mock.patch('download_artifacts.get_build',
+                        side_effect=[running, self.http500, running, passed,
+                                     self.rate_limited('45'), passed_with_retries]) as get_build, \
+                mock.patch('download_artifacts.sleep', return_value=False) as sleep:
+            self.assertEqual(passed_with_retries, wait_for_build(buildkite, 'org', 'pipeline', 1, 30))
+            self.assertEqual([mock.call(30), mock.call(30), mock.call(60), mock.call(45)], sleep.mock_calls)
+            self.assertEqual([mock.call(buildkite, 'org', 'pipeline', 1, include_retried_jobs=False)] * 4 +
+                             [mock.call(buildkite, 'org', 'pipeline', 1, include_retried_jobs=True)] * 2,
+                             get_build.mock_calls)
+
+        with mock.patch('download_artifacts.get_build', return_value=running), \
+                mock.patch('download_artifacts.sleep', return_value=True):
+            self.assertIsNone(wait_for_build(mock.MagicMock(), 'org', 'pipeline', 1, 30))
+            self.assertIsNone(wait_for_build_in_background(mock.MagicMock(), 'org', 'pipeline', 1, 30).result())
+
+        with mock.patch('download_artifacts.get_build', side_effect=self.http404):
+            with self.assertRaises(HTTPError):
+                wait_for_build_in_background(mock.MagicMock(), 'org', 'pipeline', 1, 30).result()
+
+        # the build gets polled until cancel is set
+        cancel = Event()
+        with mock.patch('download_artifacts.get_build', return_value=running) as get_build, \
+                mock.patch('download_artifacts.sleep', side_effect=lambda seconds: cancel.set()) as sleep:
+            self.assertIsNone(wait_for_build_in_background(mock.MagicMock(), 'org', 'pipeline', 1, 30, cancel).result())
+            self.assertEqual(1, get_build.call_count)
+            sleep.assert_called_once_with(30)
+
+        with mock.patch('download_artifacts.get_build') as get_build:
+            self.assertIsNone(wait_for_build(mock.MagicMock(), 'org', 'pipeline', 1, 30, cancel))
+            get_build.assert_not_called()
+
+    def test_format_size(self):
+        self.assertEqual('0 Bytes', format_size(0))
+        self.assertEqual('1 Byte', format_size(1))
+        self.assertEqual('999 Bytes', format_size(999))
+        self.assertEqual('1.0 kB', format_size(1000))
+        self.assertEqual('1000 Bytes', format_size(1000, binary=True))
+        self.assertEqual('1.5 KiB', format_size(1536, binary=True))
+        self.assertEqual('123.5 MB', format_size(123456789))
+        self.assertEqual('5.0 GiB', format_size(5 * 1024 ** 3, binary=True))
+
+    def test_format_duration(self):
+        self.assertEqual('a moment', format_duration(0.5))
+        self.assertEqual('a second', format_duration(1))
+        self.assertEqual('5 seconds', format_duration(5.7))
+        self.assertEqual('a minute', format_duration(80))
+        self.assertEqual('5 minutes', format_duration(320))
+        self.assertEqual('an hour', format_duration(3600))
+        self.assertEqual('22 hours', format_duration(80000))
+
     def test_make_dict_path_safe(self):
         self.assertEqual(dict(), make_dict_path_safe(dict(), dict()))
         self.assertEqual(dict(id='name'), make_dict_path_safe(dict(id='name'), dict()))
@@ -41,6 +171,84 @@ class DownloadTest(unittest.TestCase):
             ))
 
         self.assertEqual(dict(id1='name-run-1', id2='name-run-2', id3='name3'), make_dict_path_safe(dict(id1='name', id2='name', id3='name3'), dict(id1=1, id2=2)))
+        self.assertEqual(dict(id1='name', id2='name_2', id3='name_2_2'), make_dict_path_safe(dict(id1='name', id2='name', id3='name_2'), dict()))
+        self.assertEqual(dict(id1='name_2', id2='name', id3='name_3'), make_dict_path_safe(dict(id1='name_2', id2='name', id3='name'), dict()))
+
+    @staticmethod
+    def response(code: int, content: bytes = b'', headers: Mapping[str, str] = None) -> Response:
+        response = Response()
+        response.status_code = code
+        response._content = content
+        response.headers.update(headers or {})
+        return response
+
+    def test_conditional_session(self):
+        adapter = mock.Mock(send=mock.Mock(side_effect=[
+            self.response(200, b'{"state": "running"}', {'ETag': '"etag1"'}),
+            self.response(304),
+            self.response(200, b'{"state": "passed"}', {'ETag': '"etag2"'}),
+            self.response(200, b'{"other": "url"}'),
+            self.response(200, b'{"other": "url"}'),
+        ]))
+        session = ConditionalSession()
+        session.mount('https://', adapter)
+
+        url = 'https://api.buildkite.com/v2/build'
+        self.assertEqual({'state': 'running'}, session.get(url).json())
+        self.assertEqual({'state': 'running'}, session.get(url).json())
+        self.assertEqual({'state': 'passed'}, session.get(url).json())
+        self.assertEqual({'other': 'url'}, session.get(url + '?page=2').json())
+        self.assertEqual({'other': 'url'}, session.get(url + '?page=2').json())
+
+        sent = [call.args[0] for call in adapter.send.mock_calls]
+        self.assertEqual([None, '"etag1"', '"etag1"', None, None],
+                         [request.headers.get('If-None-Match') for request in sent])
+
+    def test_buildkite_client_stream(self):
+        response = self.response(200, headers={'content-type': 'application/octet-stream'})
+        response.raw = io.BytesIO(b'x' * (DOWNLOAD_CHUNK_SIZE * 2 + 1))
+        session = mock.Mock(request=mock.Mock(return_value=response))
+        client = BuildkiteClient(session)
+        client.set_client_access_token('token')
+
+        headers = {'Accept': 'application/octet-stream'}
+        chunks = client.get('https://api.buildkite.com/download', headers=headers, as_stream=True)
+
+        self.assertEqual([DOWNLOAD_CHUNK_SIZE, DOWNLOAD_CHUNK_SIZE, 1], [len(chunk) for chunk in chunks])
+        session.request.assert_called_once_with(
+            'GET', 'https://api.buildkite.com/download',
+            headers={'Accept': 'application/octet-stream', 'Authorization': 'Bearer token'},
+            params=b'per_page=100', json=None, stream=True, timeout=BUILDKITE_TIMEOUT
+        )
+        # the caller's headers are not modified
+        self.assertEqual({'Accept': 'application/octet-stream'}, headers)
+
+    def test_get_buildkite(self):
+        buildkite = get_buildkite('token', 16)
+        self.assertIsInstance(buildkite.client, BuildkiteClient)
+        self.assertEqual('token', buildkite.client.access_token)
+        adapter = buildkite.client._session.get_adapter('https://api.buildkite.com/')
+        self.assertEqual(16 + BUILD_POLLERS_POOL_SIZE, adapter._pool_maxsize)
+
+        buildkite = get_buildkite('token', 1)
+        adapter = buildkite.client._session.get_adapter('https://api.buildkite.com/')
+        self.assertEqual(ARTIFACT_PAGES_CONCURRENCY + BUILD_POLLERS_POOL_SIZE, adapter._pool_maxsize)
+
+    def test_get_buildkite_builds_from_github(self):
+        status = {
+            'total_count': 3,
+            'statuses': [
+                {'context': 'buildkite/pipeline', 'state': 'pending', 'target_url': 'https://buildkite.com/org/pipeline/builds/1'},
+                {'context': 'ci/other', 'state': 'success', 'target_url': 'https://ci.example.com/1'},
+                {'context': 'buildkite/other-pipeline', 'state': 'success', 'target_url': 'https://buildkite.com/org/other-pipeline/builds/2'},
+            ]
+        }
+        github = mock.Mock(get=mock.Mock(return_value=self.response(200, json.dumps(status).encode('utf8'))))
+
+        self.assertEqual(['https://buildkite.com/org/pipeline/builds/1', 'https://buildkite.com/org/other-pipeline/builds/2'],
+                         get_buildkite_builds_from_github(github, 'https://api.github.com', 'owner/repo', 'sha'))
+        github.get.assert_called_once_with('https://api.github.com/repos/owner/repo/commits/sha/status',
+                                           params={'per_page': 100}, timeout=GITHUB_TIMEOUT)
 
     @staticmethod
     def error(code: int, message: str) -> HTTPError:
@@ -50,29 +258,76 @@ class DownloadTest(unittest.TestCase):
         return HTTPError(f'Exception {code} {message}', response=response)
 
     http404 = error.__func__(404, 'Not Found')
+    http403 = error.__func__(403, 'Forbidden')
     http500 = error.__func__(500, 'Internal Server Error')
     connection_error = requests.exceptions.ConnectionError('Connection aborted.', ConnectionResetError(104, 'Connection reset by peer'))
     exception = Exception()
 
+    class RecordingHandler(logging.Handler):
+        def __init__(self):
+            super().__init__(logging.DEBUG)
+            self.records = []
+
+        def emit(self, record: logging.LogRecord):
+            exception = record.exc_info[1] if record.exc_info else None
+            self.records.append((record.levelname, record.getMessage(), exception))
+
+    @contextlib.contextmanager
+    def capture_logs(self) -> Iterator[List[Tuple[str, str, Optional[BaseException]]]]:
+        # records (level, message, exception) of everything logged by the action at debug level
+        handler = self.RecordingHandler()
+        level, propagate = logger.level, logger.propagate
+        logger.addHandler(handler)
+        logger.setLevel(logging.DEBUG)
+        logger.propagate = False
+        try:
+            yield handler.records
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(level)
+            logger.propagate = propagate
+
+    @staticmethod
+    def list_tree(root: str) -> List[str]:
+        # paths of all files and directories below root (including root), relative to root and starting with '/'
+        paths = ['/']
+        dirs = [root]
+        while dirs:
+            with os.scandir(dirs.pop()) as entries:
+                for entry in entries:
+                    paths.append('/' + os.path.relpath(entry.path, root))
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+        return paths
+
     def create_buildkite_mock(self,
                               artifact_ids: Set[str],
                               errors: Mapping[str, List[HTTPError]]=None):
         if errors is None:
             errors = dict()
 
-        def download(org, pipeline, build_number, job_id, artifact_id):
+        def download(org, pipeline, build_number, job_id, artifact_id, as_stream=False):
             if artifact_id in errors:
                 error = errors[artifact_id].pop()
                 if len(errors[artifact_id]) == 0:
                     del errors[artifact_id]
                 raise error
             elif artifact_id in artifact_ids:
-                return str(artifact_id).encode('utf8')
+                content = str(artifact_id).encode('utf8')
+                return iter([content[:1], content[1:]]) if as_stream else content
             else:
                 raise self.http404
 
         return mock.Mock(artifacts=mock.Mock(return_value=mock.Mock(download_artifact=mock.Mock(side_effect=download))))
 
+    @staticmethod
+    def rate_limited(retry_after: str) -> HTTPError:
+        response = Response()
+        response.status_code = 429
+        response.reason = 'Too Many Requests'
+        response.headers['Retry-After'] = retry_after
+        return HTTPError('Exception 429 Too Many Requests', response=response)
+
     org = 'org'
     pipeline = 'pipeline'
     build_number = 12345
@@ -82,7 +337,8 @@ class DownloadTest(unittest.TestCase):
             {'id1', 'id2', 'id3', 'id4', 'id5'},
             {'id6': [self.http404]}
         )
-        downloader = Downloader()
+        sleep = mock.Mock(return_value=False)
+        downloader = Downloader(concurrency=1, sleep=sleep)
         artifacts = [
             {'id': 'id1', 'job_id': 'jid1', 'path': 'path1', 'state': 'unknown'},
             {'id': 'id2', 'job_id': 'jid2', 'path': 'path2', 'state': 'new'},
@@ -94,8 +350,8 @@ class DownloadTest(unittest.TestCase):
         job_names = {artifact['id']: f'file-{artifact["id"]}' for artifact in artifacts}
 
         with tempfile.TemporaryDirectory() as path, \
-                mock.patch('download_artifacts.logger') as logger, \
-                mock.patch('download_artifacts.time.sleep') as time:
+                self.capture_logs() as logs, \
+                mock.patch('download_artifacts.random.uniform', return_value=0):
 
             ga = mock.MagicMock()
             downloaded_paths, failed_ids = downloader.download_artifacts(
@@ -103,21 +359,21 @@ class DownloadTest(unittest.TestCase):
             )
 
             self.assertEqual(
-                [mock.call.info('Downloading 4 artifacts from build 12345.'),
-                 mock.call.debug(f'Writing 3 bytes to {path}/jid2/path2.'),
-                 mock.call.debug(f'Writing 3 bytes to {path}/jid4/path4.'),
-                 mock.call.debug(f'Writing 3 bytes to {path}/jid5/path5.'),
-                 mock.call.debug(f'Downloading artifact id6 to {path}/jid6/path6 failed.', exc_info=self.http404),
-                 mock.call.info('Downloaded 3 artifacts and 9 Bytes, 1 artifact failed.')],
-                logger.mock_calls
+                [('INFO', 'Downloading 4 artifacts from build 12345.', None),
+                 ('DEBUG', f'Wrote 3 bytes to {path}/jid2/path2.', None),
+                 ('DEBUG', f'Wrote 3 bytes to {path}/jid4/path4.', None),
+                 ('DEBUG', f'Wrote 3 bytes to {path}/jid5/path5.', None),
+                 ('DEBUG', f'Downloading artifact id6 to {path}/jid6/path6 failed.', self.http404),
+                 ('INFO', 'Downloaded 3 artifacts and 9 Bytes, 1 artifact failed.', None)],
+                logs
             )
             ga.warning.assert_not_called()
 
             self.assertEqual(
-                [mock.call(self.org, self.pipeline, self.build_number, 'jid2', 'id2'),
-                 mock.call(self.org, self.pipeline, self.build_number, 'jid4', 'id4'),
-                 mock.call(self.org, self.pipeline, self.build_number, 'jid5', 'id5'),
-                 mock.call(self.org, self.pipeline, self.build_number, 'jid6', 'id6')],
+                [mock.call(self.org, self.pipeline, self.build_number, 'jid2', 'id2', as_stream=True),
+                 mock.call(self.org, self.pipeline, self.build_number, 'jid4', 'id4', as_stream=True),
+                 mock.call(self.org, self.pipeline, self.build_number, 'jid5', 'id5', as_stream=True),
+                 mock.call(self.org, self.pipeline, self.build_number, 'jid6', 'id6', as_stream=True)],
                 buildkite.artifacts.return_value.download_artifact.mock_calls
             )
 
@@ -127,11 +383,10 @@ class DownloadTest(unittest.TestCase):
                  '/jid4', '/jid4/path4',
                  '/jid5', '/jid5/path5',
                  '/jid6'],
-                sorted([file[file.startswith(path) and len(path):]
-                        for file in glob(os.path.join(path, '**'), recursive=True)])
+                sorted(self.list_tree(path))
             )
 
-            self.assertEqual([], time.mock_calls)
+            self.assertEqual([], sleep.mock_calls)
             self.assertEqual(['/jid2/path2', '/jid4/path4', '/jid5/path5'],
                              [downloaded_path[downloaded_path.startswith(path) and len(path):]
                               for downloaded_path in downloaded_paths])
@@ -164,10 +419,11 @@ class DownloadTest(unittest.TestCase):
         ]
         job_names = {artifact['id']: f'file-{artifact["id"]}' for artifact in artifacts}
 
-        downloader = Downloader()
+        sleep = mock.Mock(return_value=False)
+        downloader = Downloader(concurrency=1, sleep=sleep)
         with tempfile.TemporaryDirectory() as path, \
-                mock.patch('download_artifacts.logger') as logger, \
-                mock.patch('download_artifacts.time.sleep') as time:
+                self.capture_logs() as logs, \
+                mock.patch('download_artifacts.random.uniform', return_value=0):
 
             ga = mock.MagicMock()
             downloaded_paths, failed_ids = downloader.download_artifacts(
@@ -175,39 +431,39 @@ class DownloadTest(unittest.TestCase):
             )
 
             self.assertEqual(
-                [mock.call.info('Downloading 6 artifacts from build 12345.'),
-                 mock.call.debug(f'Writing 3 bytes to {path}/jid1/path1.'),
-                 mock.call.debug(f'Downloading artifact id2 to {path}/jid2/path2 failed.', exc_info=self.http500),
-                 mock.call.debug(f'Downloading artifact id3 to {path}/jid3/path3 failed.', exc_info=self.http500),
-                 mock.call.debug(f'Downloading artifact id4 to {path}/jid4/path4 failed.', exc_info=self.connection_error),
-                 mock.call.debug(f'Downloading artifact id5 to {path}/jid5/path5 failed.', exc_info=self.http404),
-                 mock.call.debug(f'Downloading artifact id6 to {path}/jid6/path6 failed.', exc_info=self.http404),
-                 mock.call.info('Download of 4 artifacts failed, retrying in 5 seconds.'),
-                 mock.call.debug(f'Writing 3 bytes to {path}/jid2/path2.'),
-                 mock.call.debug(f'Downloading artifact id3 to {path}/jid3/path3 failed.', exc_info=self.http500),
-                 mock.call.debug(f'Downloading artifact id4 to {path}/jid4/path4 failed.', exc_info=self.exception),
-                 mock.call.debug(f'Writing 3 bytes to {path}/jid5/path5.'),
-                 mock.call.info('Download of 2 artifacts failed, retrying in 20 seconds.'),
-                 mock.call.debug(f'Writing 3 bytes to {path}/jid3/path3.'),
-                 mock.call.debug(f'Writing 3 bytes to {path}/jid4/path4.'),
-                 mock.call.info('Downloaded 5 artifacts and 15 Bytes, 1 artifact failed.')],
-                logger.mock_calls
+                [('INFO', 'Downloading 6 artifacts from build 12345.', None),
+                 ('DEBUG', f'Wrote 3 bytes to {path}/jid1/path1.', None),
+                 ('DEBUG', f'Downloading artifact id2 to {path}/jid2/path2 failed.', self.http500),
+                 ('DEBUG', f'Downloading artifact id3 to {path}/jid3/path3 failed.', self.http500),
+                 ('DEBUG', f'Downloading artifact id4 to {path}/jid4/path4 failed.', self.connection_error),
+                 ('DEBUG', f'Downloading artifact id5 to {path}/jid5/path5 failed.', self.http404),
+                 ('DEBUG', f'Downloading artifact id6 to {path}/jid6/path6 failed.', self.http404),
+                 ('INFO', 'Download of 4 artifacts failed, retrying in 5 seconds.', None),
+                 ('DEBUG', f'Wrote 3 bytes to {path}/jid2/path2.', None),
+                 ('DEBUG', f'Downloading artifact id3 to {path}/jid3/path3 failed.', self.http500),
+                 ('DEBUG', f'Downloading artifact id4 to {path}/jid4/path4 failed.', self.exception),
+                 ('DEBUG', f'Wrote 3 bytes to {path}/jid5/path5.', None),
+                 ('INFO', 'Download of 2 artifacts failed, retrying in 20 seconds.', None),
+                 ('DEBUG', f'Wrote 3 bytes to {path}/jid3/path3.', None),
+                 ('DEBUG', f'Wrote 3 bytes to {path}/jid4/path4.', None),
+                 ('INFO', 'Downloaded 5 artifacts and 15 Bytes, 1 artifact failed.', None)],
+                logs
             )
             ga.warning.assert_not_called()
 
             self.assertEqual(
-                [mock.call(self.org, self.pipeline, self.build_number, 'jid1', 'id1'),
-                 mock.call(self.org, self.pipeline, self.build_number, 'jid2', 'id2'),
-                 mock.call(self.org, self.pipeline, self.build_number, 'jid3', 'id3'),
-                 mock.call(self.org, self.pipeline, self.build_number, 'jid4', 'id4'),
-                 mock.call(self.org, self.pipeline, self.build_number, 'jid5', 'id5'),
-                 mock.call(self.org, self.pipeline, self.build_number, 'jid6', 'id6'),
-                 mock.call(self.org, self.pipeline, self.build_number, 'jid2', 'id2'),
-                 mock.call(self.org, self.pipeline, self.build_number, 'jid3', 'id3'),
-                 mock.call(self.org, self.pipeline, self.build_number, 'jid4', 'id4'),
-                 mock.call(self.org, self.pipeline, self.build_number, 'jid5', 'id5'),
-                 mock.call(self.org, self.pipeline, self.build_number, 'jid3', 'id3'),
-                 mock.call(self.org, self.pipeline, self.build_number, 'jid4', 'id4')],
+                [mock.call(self.org, self.pipeline, self.build_number, 'jid1', 'id1', as_stream=True),
+                 mock.call(self.org, self.pipeline, self.build_number, 'jid2', 'id2', as_stream=True),
+                 mock.call(self.org, self.pipeline, self.build_number, 'jid3', 'id3', as_stream=True),
+                 mock.call(self.org, self.pipeline, self.build_number, 'jid4', 'id4', as_stream=True),
+                 mock.call(self.org, self.pipeline, self.build_number, 'jid5', 'id5', as_stream=True),
+                 mock.call(self.org, self.pipeline, self.build_number, 'jid6', 'id6', as_stream=True),
+                 mock.call(self.org, self.pipeline, self.build_number, 'jid2', 'id2', as_stream=True),
+                 mock.call(self.org, self.pipeline, self.build_number, 'jid3', 'id3', as_stream=True),
+                 mock.call(self.org, self.pipeline, self.build_number, 'jid4', 'id4', as_stream=True),
+                 mock.call(self.org, self.pipeline, self.build_number, 'jid5', 'id5', as_stream=True),
+                 mock.call(self.org, self.pipeline, self.build_number, 'jid3', 'id3', as_stream=True),
+                 mock.call(self.org, self.pipeline, self.build_number, 'jid4', 'id4', as_stream=True)],
                 buildkite.artifacts.return_value.download_artifact.mock_calls
             )
 
@@ -219,11 +475,10 @@ class DownloadTest(unittest.TestCase):
                  '/jid4', '/jid4/path4',
                  '/jid5', '/jid5/path5',
                  '/jid6'],
-                sorted([file[file.startswith(path) and len(path):]
-                        for file in glob(os.path.join(path, '**'), recursive=True)])
+                sorted(self.list_tree(path))
             )
 
-            self.assertEqual([mock.call(5), mock.call(20)], time.mock_calls)
+            self.assertEqual([mock.call(5), mock.call(20)], sleep.mock_calls)
             self.assertEqual(['/jid1/path1', '/jid2/path2', '/jid5/path5', '/jid3/path3', '/jid4/path4'],
                              [downloaded_path[downloaded_path.startswith(path) and len(path):]
                               for downloaded_path in downloaded_paths])
@@ -233,7 +488,8 @@ class DownloadTest(unittest.TestCase):
         buildkite = self.create_buildkite_mock(
             {'id1', 'id2'}, {'id1': [self.http500] * 5, 'id2': [self.http404] * 5}
         )
-        downloader = Downloader()
+        sleep = mock.Mock(return_value=False)
+        downloader = Downloader(concurrency=1, sleep=sleep)
         artifacts = [
             {'id': 'id1', 'job_id': 'jid1', 'path': 'path1', 'state': 'finished'},
             {'id': 'id2', 'job_id': 'jid2', 'path': 'path2', 'state': 'new'},
@@ -241,8 +497,8 @@ class DownloadTest(unittest.TestCase):
         job_names = {artifact['id']: f'file-{artifact["id"]}' for artifact in artifacts}
 
         with tempfile.TemporaryDirectory() as path, \
-                mock.patch('download_artifacts.logger') as logger, \
-                mock.patch('download_artifacts.time.sleep') as time:
+                self.capture_logs() as logs, \
+                mock.patch('download_artifacts.random.uniform', return_value=0):
 
             ga = mock.MagicMock()
             downloaded_paths, failed_ids = downloader.download_artifacts(
@@ -250,49 +506,353 @@ class DownloadTest(unittest.TestCase):
             )
 
             self.assertEqual(
-                [mock.call.info('Downloading 2 artifacts from build 12345.'),
-                 mock.call.debug(f'Downloading artifact id1 to {path}/jid1/path1 failed.', exc_info=self.http500),
-                 mock.call.debug(f'Downloading artifact id2 to {path}/jid2/path2 failed.', exc_info=self.http404),
-                 mock.call.info('Download of 2 artifacts failed, retrying in 5 seconds.'),
-                 mock.call.debug(f'Downloading artifact id1 to {path}/jid1/path1 failed.', exc_info=self.http500),
-                 mock.call.debug(f'Downloading artifact id2 to {path}/jid2/path2 failed.', exc_info=self.http404),
-                 mock.call.info('Download of 2 artifacts failed, retrying in 20 seconds.'),
-                 mock.call.debug(f'Downloading artifact id1 to {path}/jid1/path1 failed.', exc_info=self.http500),
-                 mock.call.debug(f'Downloading artifact id2 to {path}/jid2/path2 failed.', exc_info=self.http404),
-                 mock.call.info('Download of 2 artifacts failed, retrying in a minute.'),
-                 mock.call.debug(f'Downloading artifact id1 to {path}/jid1/path1 failed.', exc_info=self.http500),
-                 mock.call.debug(f'Downloading artifact id2 to {path}/jid2/path2 failed.', exc_info=self.http404),
-                 mock.call.info('Download of 2 artifacts failed, retrying in 5 minutes.'),
-                 mock.call.debug(f'Downloading artifact id1 to {path}/jid1/path1 failed.', exc_info=self.http500),
-                 mock.call.debug(f'Downloading artifact id2 to {path}/jid2/path2 failed.', exc_info=self.http404),
-                 mock.call.debug('Failed artifacts:'),
-                 mock.call.debug({'id': 'id1', 'job_id': 'jid1', 'path': 'path1', 'state': 'finished'}),
-                 mock.call.debug({'id': 'id2', 'job_id': 'jid2', 'path': 'path2', 'state': 'new'}),
-                 mock.call.info('Downloaded 0 artifacts and 0 Bytes, 2 artifacts failed.')],
-                logger.mock_calls
+                [('INFO', 'Downloading 2 artifacts from build 12345.', None),
+                 ('DEBUG', f'Downloading artifact id1 to {path}/jid1/path1 failed.', self.http500),
+                 ('DEBUG', f'Downloading artifact id2 to {path}/jid2/path2 failed.', self.http404),
+                 ('INFO', 'Download of 2 artifacts failed, retrying in 5 seconds.', None),
+                 ('DEBUG', f'Downloading artifact id1 to {path}/jid1/path1 failed.', self.http500),
+                 ('DEBUG', f'Downloading artifact id2 to {path}/jid2/path2 failed.', self.http404),
+                 ('INFO', 'Download of 2 artifacts failed, retrying in 20 seconds.', None),
+                 ('DEBUG', f'Downloading artifact id1 to {path}/jid1/path1 failed.', self.http500),
+                 ('DEBUG', f'Downloading artifact id2 to {path}/jid2/path2 failed.', self.http404),
+                 ('INFO', 'Download of 2 artifacts failed, retrying in a minute.', None),
+                 ('DEBUG', f'Downloading artifact id1 to {path}/jid1/path1 failed.', self.http500),
+                 ('DEBUG', f'Downloading artifact id2 to {path}/jid2/path2 failed.', self.http404),
+                 ('INFO', 'Download of 2 artifacts failed, retrying in 5 minutes.', None),
+                 ('DEBUG', f'Downloading artifact id1 to {path}/jid1/path1 failed.', self.http500),
+                 ('DEBUG', f'Downloading artifact id2 to {path}/jid2/path2 failed.', self.http404),
+                 ('DEBUG', 'Failed artifacts:', None),
+                 ('DEBUG', str({'id': 'id1', 'job_id': 'jid1', 'path': 'path1', 'state': 'finished'}), None),
+                 ('DEBUG', str({'id': 'id2', 'job_id': 'jid2', 'path': 'path2', 'state': 'new'}), None),
+                 ('INFO', 'Downloaded 0 artifacts and 0 Bytes, 2 artifacts failed.', None)],
+                logs
             )
             ga.warning.assert_called_once_with('Download of 2 artifacts failed, giving up.')
 
             self.assertEqual(
-                [mock.call(self.org, self.pipeline, self.build_number, 'jid1', 'id1'),
-                 mock.call(self.org, self.pipeline, self.build_number, 'jid2', 'id2'),
-                 mock.call(self.org, self.pipeline, self.build_number, 'jid1', 'id1'),
-                 mock.call(self.org, self.pipeline, self.build_number, 'jid2', 'id2'),
-                 mock.call(self.org, self.pipeline, self.build_number, 'jid1', 'id1'),
-                 mock.call(self.org, self.pipeline, self.build_number, 'jid2', 'id2'),
-                 mock.call(self.org, self.pipeline, self.build_number, 'jid1', 'id1'),
-                 mock.call(self.org, self.pipeline, self.build_number, 'jid2', 'id2'),
-                 mock.call(self.org, self.pipeline, self.build_number, 'jid1', 'id1'),
-                 mock.call(self.org, self.pipeline, self.build_number, 'jid2', 'id2')],
+                [mock.call(self.org, self.pipeline, self.build_number, 'jid1', 'id1', as_stream=True),
+                 mock.call(self.org, self.pipeline, self.build_number, 'jid2', 'id2', as_stream=True),
+                 mock.call(self.org, self.pipeline, self.build_number, 'jid1', 'id1', as_stream=True),
+                 mock.call(self.org, self.pipeline, self.build_number, 'jid2', 'id2', as_stream=True),
+                 mock.call(self.org, self.pipeline, self.build_number, 'jid1', 'id1', as_stream=True),
+                 mock.call(self.org, self.pipeline, self.build_number, 'jid2', 'id2', as_stream=True),
+                 mock.call(self.org, self.pipeline, self.build_number, 'jid1', 'id1', as_stream=True),
+                 mock.call(self.org, self.pipeline, self.build_number, 'jid2', 'id2', as_stream=True),
+                 mock.call(self.org, self.pipeline, self.build_number, 'jid1', 'id1', as_stream=True),
+                 mock.call(self.org, self.pipeline, self.build_number, 'jid2', 'id2', as_stream=True)],
                 buildkite.artifacts.return_value.download_artifact.mock_calls
             )
 
             self.assertEqual(
                 ['/', '/jid1', '/jid2'],
-                [file[file.startswith(path) and len(path):]
-                 for file in sorted(glob(os.path.join(path, '**'), recursive=True))]
+                sorted(self.list_tree(path))
+            )
+
+            self.assertEqual([mock.call(5), mock.call(20), mock.call(80), mock.call(320)], sleep.mock_calls)
+            self.assertEqual([], downloaded_paths)
+            self.assertEqual({'id1', 'id2'}, failed_ids)
+
+    def test_download_artifacts_concurrently(self):
+        artifact_ids = {f'id{i}' for i in range(1, 21)}
+        buildkite = self.create_buildkite_mock(artifact_ids, {'id3': [self.http500], 'id7': [self.http404]})
+        sleep = mock.Mock(return_value=False)
+        downloader = Downloader(concurrency=4, sleep=sleep)
+        artifacts = [{'id': f'id{i}', 'job_id': f'jid{i}', 'path': f'path{i}', 'state': 'finished'}
+                     for i in range(1, 21)]
+        job_names = {artifact['id']: f'file-{artifact["id"]}' for artifact in artifacts}
+
+        with tempfile.TemporaryDirectory() as path, \
+                self.capture_logs(), \
+                mock.patch('download_artifacts.random.uniform', return_value=0):
+
+            ga = mock.MagicMock()
+            downloaded_paths, failed_ids = downloader.download_artifacts(
+                buildkite, self.org, self.pipeline, self.build_number, artifacts, job_names, path, ga
+            )
+
+            self.assertCountEqual(
+                [mock.call(self.org, self.pipeline, self.build_number, f'jid{i}', f'id{i}', as_stream=True) for i in range(1, 21)] +
+                [mock.call(self.org, self.pipeline, self.build_number, 'jid3', 'id3', as_stream=True)],
+                buildkite.artifacts.return_value.download_artifact.mock_calls
+            )
+            self.assertEqual([mock.call(5)], sleep.mock_calls)
+
+            # downloaded paths are in order of artifacts, retried artifacts come last
+            self.assertEqual([f'/jid{i}/path{i}' for i in range(1, 21) if i not in [3, 7]] + ['/jid3/path3'],
+                             [downloaded_path[downloaded_path.startswith(path) and len(path):]
+                              for downloaded_path in downloaded_paths])
+            self.assertEqual({'id7'}, failed_ids)
+
+    def test_download_artifacts_rate_limited(self):
+        http429 = self.rate_limited('60')
+        buildkite = self.create_buildkite_mock({'id1', 'id2'}, {'id1': [http429], 'id2': [self.http500]})
+        sleep = mock.Mock(return_value=False)
+        downloader = Downloader(concurrency=1, sleep=sleep)
+        artifacts = [
+            {'id': 'id1', 'job_id': 'jid1', 'path': 'path1', 'state': 'finished'},
+            {'id': 'id2', 'job_id': 'jid2', 'path': 'path2', 'state': 'finished'},
+        ]
+        job_names = {artifact['id']: f'file-{artifact["id"]}' for artifact in artifacts}
+
+        with tempfile.TemporaryDirectory() as path, \
+                self.capture_logs() as logs, \
+                mock.patch('download_artifacts.random.uniform', return_value=3) as uniform:
+
+            ga = mock.MagicMock()
+            downloaded_paths, failed_ids = downloader.download_artifacts(
+                buildkite, self.org, self.pipeline, self.build_number, artifacts, job_names, path, ga
+            )
+
+            self.assertEqual(
+                [('INFO', 'Downloading 2 artifacts from build 12345.', None),
+                 ('DEBUG', f'Downloading artifact id1 to {path}/jid1/path1 failed.', http429),
+                 ('DEBUG', f'Downloading artifact id2 to {path}/jid2/path2 failed.', self.http500),
+                 ('INFO', 'Download of 2 artifacts failed, retrying in a minute.', None),
+                 ('DEBUG', f'Wrote 3 bytes to {path}/jid1/path1.', None),
+                 ('DEBUG', f'Wrote 3 bytes to {path}/jid2/path2.', None),
+                 ('INFO', 'Downloaded 2 artifacts and 6 Bytes.', None)],
+                logs
+            )
+
+            # Retry-After of 60s supersedes the first delay of 5s, jitter is up to 20% of that
+            self.assertEqual([mock.call(0, 12.0)], uniform.mock_calls)
+            self.assertEqual([mock.call(63)], sleep.mock_calls)
+            self.assertEqual(set(), failed_ids)
+
+    def test_download_artifacts_exist(self):
+        buildkite = self.create_buildkite_mock({'id1', 'id2', 'id3', 'id4'})
+        downloader = Downloader(concurrency=1)
+        sha1 = hashlib.sha1(b'id1').hexdigest()
+        artifacts = [
+            # exists with same size and checksum
+            {'id': 'id1', 'job_id': 'jid1', 'path': 'path1', 'state': 'finished', 'file_size': 3, 'sha1sum': sha1},
+            # exists with same size but different checksum
+            {'id': 'id2', 'job_id': 'jid2', 'path': 'path2', 'state': 'finished', 'file_size': 3, 'sha1sum': sha1},
+            # exists with different size
+            {'id': 'id3', 'job_id': 'jid3', 'path': 'path3', 'state': 'finished', 'file_size': 4, 'sha1sum': sha1},
+            # does not exist
+            {'id': 'id4', 'job_id': 'jid4', 'path': 'path4', 'state': 'finished', 'file_size': 3, 'sha1sum': sha1},
+        ]
+        job_names = {artifact['id']: f'file-{artifact["id"]}' for artifact in artifacts}
+
+        with tempfile.TemporaryDirectory() as path, \
+                self.capture_logs() as logs:
+            for artifact in artifacts[:3]:
+                os.makedirs(os.path.join(path, artifact['job_id']))
+                with open(os.path.join(path, artifact['job_id'], artifact['path']), 'wb') as f:
+                    f.write(artifact['id'].encode('utf8'))
+
+            ga = mock.MagicMock()
+            downloaded_paths, failed_ids = downloader.download_artifacts(
+                buildkite, self.org, self.pipeline, self.build_number, artifacts, job_names, path, ga
+            )
+
+            self.assertEqual(
+                [('INFO', 'Downloading 4 artifacts from build 12345.', None),
+                 ('DEBUG', f'Skipping artifact id1 as {path}/jid1/path1 exists already.', None),
+                 ('DEBUG', f'Wrote 3 bytes to {path}/jid2/path2.', None),
+                 ('DEBUG', f'Wrote 3 bytes to {path}/jid3/path3.', None),
+                 ('DEBUG', f'Wrote 3 bytes to {path}/jid4/path4.', None),
+                 ('INFO', 'Downloaded 4 artifacts and 9 Bytes.', None)],
+                logs
+            )
+            self.assertEqual(
+                [mock.call(self.org, self.pipeline, self.build_number, f'jid{i}', f'id{i}', as_stream=True)
+                 for i in range(2, 5)],
+                buildkite.artifacts.return_value.download_artifact.mock_calls
+            )
+            self.assertEqual(4, len(downloaded_paths))
+            self.assertEqual(set(), failed_ids)
+            # preallocated for 4 bytes, but only 3 bytes downloaded
+            self.assertEqual(3, os.stat(os.path.join(path, 'jid3', 'path3')).st_size)
+
+    def test_download_artifacts_same_path(self):
+        buildkite = self.create_buildkite_mock({'id1', 'id2', 'id3'})
+        downloader = Downloader(concurrency=1)
+        artifacts = [
+            {'id': 'id1', 'job_id': 'jid1', 'path': 'path1', 'state': 'finished'},
+            {'id': 'id2', 'job_id': 'jid1', 'path': 'path1', 'state': 'finished'},
+            {'id': 'id3', 'job_id': 'jid2', 'path': 'path1', 'state': 'finished'},
+        ]
+        job_names = {artifact['id']: f'file-{artifact["id"]}' for artifact in artifacts}
+
+        with tempfile.TemporaryDirectory() as path, \
+                self.capture_logs() as logs:
+            ga = mock.MagicMock()
+            downloaded_paths, failed_ids = downloader.download_artifacts(
+                buildkite, self.org, self.pipeline, self.build_number, artifacts, job_names, path, ga
+            )
+
+            self.assertEqual(
+                [('WARNING', 'Skipping 1 artifact with the same job and path as other artifacts.', None),
+                 ('INFO', 'Downloading 2 artifacts from build 12345.', None),
+                 ('DEBUG', f'Wrote 3 bytes to {path}/jid1/path1.', None),
+                 ('DEBUG', f'Wrote 3 bytes to {path}/jid2/path1.', None),
+                 ('INFO', 'Downloaded 2 artifacts and 6 Bytes.', None)],
+                logs
+            )
+            self.assertEqual(
+                [mock.call(self.org, self.pipeline, self.build_number, 'jid1', 'id2', as_stream=True),
+                 mock.call(self.org, self.pipeline, self.build_number, 'jid2', 'id3', as_stream=True)],
+                buildkite.artifacts.return_value.download_artifact.mock_calls
+            )
+            self.assertEqual([f'{path}/jid1/path1', f'{path}/jid2/path1'], downloaded_paths)
+            self.assertEqual(set(), failed_ids)
+
+    def test_preallocate(self):
+        with tempfile.TemporaryFile() as f:
+            self.assertFalse(preallocate(f, None))
+            self.assertFalse(preallocate(f, 0))
+            self.assertEqual(0, os.fstat(f.fileno()).st_size)
+
+        if hasattr(os, 'posix_fallocate'):
+            with tempfile.TemporaryFile() as f:
+                self.assertTrue(preallocate(f, 1024))
+                self.assertEqual(1024, os.fstat(f.fileno()).st_size)
+
+            with tempfile.TemporaryFile() as f, \
+                    mock.patch('download_artifacts.os.posix_fallocate', side_effect=OSError(95, 'Operation not supported')):
+                self.assertFalse(preallocate(f, 1024))
+
+    def test_download_artifacts_broken_stream(self):
+        broken = requests.exceptions.ChunkedEncodingError('Connection broken')
+
+        def broken_stream():
+            yield b'abc'
+            raise broken
+
+        download_artifact = mock.Mock(side_effect=[broken_stream(), iter([b'abcdefghij'])])
+        buildkite = mock.Mock(artifacts=mock.Mock(return_value=mock.Mock(download_artifact=download_artifact)))
+        sleep = mock.Mock(return_value=False)
+        downloader = Downloader(concurrency=1, sleep=sleep)
+        # listed with file size but without sha1sum, so only the size tells a partial file from a complete one
+        artifacts = [{'id': 'id1', 'job_id': 'jid1', 'path': 'path1', 'state': 'finished', 'file_size': 10}]
+
+        with tempfile.TemporaryDirectory() as path, \
+                self.capture_logs() as logs, \
+                mock.patch('download_artifacts.random.uniform', return_value=0):
+            ga = mock.MagicMock()
+            downloaded_paths, failed_ids = downloader.download_artifacts(
+                buildkite, self.org, self.pipeline, self.build_number, artifacts, dict(), path, ga
+            )
+
+            self.assertEqual(
+                [('INFO', 'Downloading 1 artifact from build 12345.', None),
+                 ('DEBUG', f'Downloading artifact id1 to {path}/jid1/path1 failed.', broken),
+                 ('INFO', 'Download of 1 artifact failed, retrying in 5 seconds.', None),
+                 ('DEBUG', f'Wrote 10 bytes to {path}/jid1/path1.', None),
+                 ('INFO', 'Downloaded 1 artifact and 10 Bytes.', None)],
+                logs
+            )
+            self.assertEqual(2, download_artifact.call_count)
+            self.assertEqual([mock.call(5)], sleep.mock_calls)
+            self.assertEqual([f'{path}/jid1/path1'], downloaded_paths)
+            self.assertEqual(set(), failed_ids)
+            with open(os.path.join(path, 'jid1', 'path1'), 'rb') as f:
+                self.assertEqual(b'abcdefghij', f.read())
+
+    def test_download_artifacts_outside_path(self):
+        buildkite = self.create_buildkite_mock({'id1'})
+        downloader = Downloader(concurrency=1)
+        artifacts = [{'id': 'id1', 'job_id': 'jid1', 'path': '../../path1', 'state': 'finished'}]
+
+        with tempfile.TemporaryDirectory() as path, self.capture_logs():
+            ga = mock.MagicMock()
+            with self.assertRaisesRegex(RuntimeError, "Cannot write artifact to '.*/path1' as output path is '.*'"):
+                downloader.download_artifacts(
+                    buildkite, self.org, self.pipeline, self.build_number, artifacts, {'jid1': 'job'}, path, ga
+                )
+            buildkite.artifacts.return_value.download_artifact.assert_not_called()
+            # progress logging stops even though the download raised
+            self.assertFalse(downloader._progress.is_alive())
+
+    def test_download_artifacts_permanent_failure(self):
+        buildkite = self.create_buildkite_mock({'id1', 'id2'}, {'id1': [self.http403], 'id2': [self.http403]})
+        sleep = mock.Mock(return_value=False)
+        downloader = Downloader(concurrency=1, sleep=sleep)
+        artifacts = [
+            {'id': 'id1', 'job_id': 'jid1', 'path': 'path1', 'state': 'finished'},
+            # forbidden artifacts are not retried, even in new state
+            {'id': 'id2', 'job_id': 'jid2', 'path': 'path2', 'state': 'new'},
+        ]
+        job_names = {artifact['id']: f'file-{artifact["id"]}' for artifact in artifacts}
+
+        with tempfile.TemporaryDirectory() as path, \
+                self.capture_logs() as logs:
+
+            ga = mock.MagicMock()
+            downloaded_paths, failed_ids = downloader.download_artifacts(
+                buildkite, self.org, self.pipeline, self.build_number, artifacts, job_names, path, ga
+            )
+
+            self.assertEqual(
+                [('INFO', 'Downloading 2 artifacts from build 12345.', None),
+                 ('DEBUG', f'Downloading artifact id1 to {path}/jid1/path1 failed.', self.http403),
+                 ('DEBUG', f'Downloading artifact id2 to {path}/jid2/path2 failed.', self.http403),
+                 ('INFO', 'Downloaded 0 artifacts and 0 Bytes, 2 artifacts failed.', None)],
+                logs
+            )
+            self.assertEqual([], sleep.mock_calls)
+            self.assertEqual([], downloaded_paths)
+            self.assertEqual({'id1', 'id2'}, failed_ids)
+
+    def test_download_artifacts_cancelled(self):
+        buildkite = self.create_buildkite_mock({'id1', 'id2'}, {'id1': [self.http500]})
+        downloader = Downloader(concurrency=1)
+        artifacts = [
+            {'id': 'id1', 'job_id': 'jid1', 'path': 'path1', 'state': 'finished'},
+            {'id': 'id2', 'job_id': 'jid2', 'path': 'path2', 'state': 'finished'},
+        ]
+        job_names = {artifact['id']: f'file-{artifact["id"]}' for artifact in artifacts}
+
+        with tempfile.TemporaryDirectory() as path, \
+                self.capture_logs(), \
+                mock.patch('download_artifacts.random.uniform', return_value=0), \
+                mock.patch('download_artifacts.stop_event') as stop_event:
+            # cancelled while sleeping between attempts, not during the first attempt
+            stop_event.is_set.return_value = False
+            stop_event.wait.return_value = True
+
+            ga = mock.MagicMock()
+            downloaded_paths, failed_ids = downloader.download_artifacts(
+                buildkite, self.org, self.pipeline, self.build_number, artifacts, job_names, path, ga
+            )
+
+            stop_event.wait.assert_called_once_with(5)
+            ga.warning.assert_called_once_with('Download of 1 artifact cancelled.')
+            self.assertEqual(1, len(downloaded_paths))
+            self.assertEqual({'id1'}, failed_ids)
+
+    def test_download_artifacts_cancelled_while_downloading(self):
+        stop_event = Event()
+
+        def cancelled_stream():
+            yield b'a'
+            stop_event.set()
+            yield b'b'
+
+        download_artifact = mock.Mock(side_effect=[cancelled_stream()])
+        buildkite = mock.Mock(artifacts=mock.Mock(return_value=mock.Mock(download_artifact=download_artifact)))
+        sleep = mock.Mock(return_value=False)
+        downloader = Downloader(concurrency=1, sleep=sleep)
+        artifacts = [
+            {'id': 'id1', 'job_id': 'jid1', 'path': 'path1', 'state': 'finished'},
+            {'id': 'id2', 'job_id': 'jid2', 'path': 'path2', 'state': 'finished'},
+        ]
+
+        with tempfile.TemporaryDirectory() as path, \
+                self.capture_logs(), \
+                mock.patch('download_artifacts.stop_event', stop_event):
+            ga = mock.MagicMock()
+            downloaded_paths, failed_ids = downloader.download_artifacts(
+                buildkite, self.org, self.pipeline, self.build_number, artifacts, dict(), path, ga
             )
 
-            self.assertEqual([mock.call(5), mock.call(20), mock.call(80), mock.call(320)], time.mock_calls)
+            # the second chunk of id1 is not written and id2 is not downloaded at all
+            self.assertEqual(1, download_artifact.call_count)
+            self.assertEqual([], sleep.mock_calls)
+            ga.warning.assert_called_once_with('Download of 2 artifacts cancelled.')
             self.assertEqual([], downloaded_paths)
             self.assertEqual({'id1', 'id2'}, failed_ids)
+            with open(os.path.join(path, 'jid1', 'path1'), 'rb') as f:
+                self.assertEqual(b'a', f.read())